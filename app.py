@@ -5,36 +5,84 @@ By: Tom Leidy + Claude 3.5 Sonnet
 """
 
 from datetime import datetime, timezone
+from functools import partial
+import hashlib
+import html
 import os
 import re
-from flask import Flask, request, jsonify, send_from_directory
+import sqlite3
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import bleach
+from sqlalchemy import event, func, select, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import raiseload, selectinload
+import orjson
 
 NAME_FIELD_SIZE = 50
 EMAIL_FIELD_SIZE = 120
 SQL_REGEX = r"(?i)(;|--|\b(drop|select|insert|delete|update|alter|create|truncate)\b)"
+_SQL_RE = re.compile(SQL_REGEX)
+# Cheap substring pre-filter: ASCII inputs containing none of these can't match SQL_REGEX
+# (non-ASCII input always goes to the regex, since casefold() and (?i) fold e.g. 'İ' differently)
+_SQL_TOKENS = ('drop', 'select', 'insert', 'delete', 'update', 'alter', 'create', 'truncate',
+               ';', '--')
+# Excluding <, >, & and ; and rejecting -- means html.escape and the ;/-- part of the SQL check
+# could never fire on an accepted email, so a full match stands in for sanitize_input. SQL keywords
+# (drop@, update@...) are deliberately allowed in addresses.
+_EMAIL_RE = re.compile(r'(?!.*--)[^@\s<>&;]{1,64}@[^@\s<>&;]{1,253}\.[^@\s<>&;]{1,63}')
 
 
 def sanitize_input(input_string):
-    sanitized = bleach.clean(input_string)
+    # names and emails are never markup; escaping <, > and & is all bleach.clean did here
+    sanitized = html.escape(input_string, quote=False)
     # check for SQL injections, just in case
-    if re.search(SQL_REGEX, sanitized):
+    if sanitized.isascii():
+        lowered = sanitized.lower()
+        if not any(token in lowered for token in _SQL_TOKENS):
+            return sanitized
+    if _SQL_RE.search(sanitized):
         raise ValueError("Invalid input detected")
     return sanitized
 
 
-def is_valid_email(email):
-    email_regex = r'^[^@]+@[^@]+\.[^@]+$'
-    return re.match(email_regex, email) is not None
+def clean_email(email):
+    """Return email unchanged if it is a safe, well-formed address, else raise ValueError."""
+    if len(email) > EMAIL_FIELD_SIZE:
+        raise ValueError(f"Email is too long: {email}")
+    if _EMAIL_RE.fullmatch(email) is None:
+        raise ValueError(f"Invalid email format: {email}")
+    return email
+
+
+class OrjsonProvider(JSONProvider):
+    """Serialize with orjson, which handles datetimes natively.
+
+    SQLite returns datetimes naive (but in UTC), hence OPT_NAIVE_UTC.
+    """
+    option = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option),
+                                        mimetype='application/json')
 
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, resources={r"/api/*": {"origins": "*",
      "methods": ["GET", "POST", "PUT", "DELETE"], "allow_headers": ["Content-Type"]}})
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///contacts.db'
+# a contact is a couple of names and a handful of emails; reject anything bigger before parsing
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
 if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres://'):
     app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace(
         'postgres://', 'postgresql://', 1)
@@ -43,21 +91,23 @@ if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres://'):
 db = SQLAlchemy(app)
 
 
-@app.before_request
-def before_request():
-    try:
-        db.create_all()
-    except OperationalError:
-        # Table already exists? Happy day
-        pass
-
-
-class TimeNow:
-    def __call__(self):
-        return datetime.now(timezone.utc)
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):  # pylint: disable=W0613
+    # WAL lets readers proceed while a PUT rewrites emails; skip for non-SQLite (Postgres) engines
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
 
 
-timenow = TimeNow()
+# partial keeps the call in C; SQLite's CURRENT_TIMESTAMP only has second resolution, too coarse
+# for the updated_at-based ETags
+timenow = partial(datetime.now, timezone.utc)
 
 
 class Contact(db.Model):
@@ -66,13 +116,25 @@ class Contact(db.Model):
     last_name = db.Column(db.String(NAME_FIELD_SIZE), nullable=False)
     created_at = db.Column(db.DateTime, default=timenow)
     updated_at = db.Column(db.DateTime, default=timenow, onupdate=timenow)
-    emails = db.relationship('Email', backref='contact', lazy=True, cascade='all, delete-orphan')
+    emails = db.relationship('Email', back_populates='contact', lazy='selectin',
+                             cascade='all, delete-orphan')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'firstName': self.first_name,
+            'lastName': self.last_name,
+            'emails': [{'id': e.id, 'email': e.email} for e in self.emails],
+            'createdAt': self.created_at,
+            'updatedAt': self.updated_at
+        }
 
 
 class Email(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(EMAIL_FIELD_SIZE), nullable=False)
-    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False, index=True)
+    contact = db.relationship('Contact', back_populates='emails')
 
 
 @app.route('/')
@@ -96,34 +158,101 @@ def init_db():
             db.create_all()
         except OperationalError as e:
             print(f"Database already initialized: {e}")
+        # create_all skips existing tables, so add indexes introduced after first deploy
+        db.session.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_email_contact_id ON email (contact_id)'))
+        db.session.commit()
+
+
+def load_contact(contact_id):
+    """Fetch a contact and its emails; in strict mode any other lazy load raises."""
+    options = [selectinload(Contact.emails)]
+    if app.config.get('TESTING_STRICT_LOADS'):
+        options.append(raiseload('*'))
+    return db.session.get(Contact, contact_id, options=options)
+
+
+def not_modified(etag):
+    """Return a 304 response if the client's cached copy matches etag, else None."""
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+        set_cache_headers(response, etag)
+        return response
+    return None
+
+
+def set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, must-revalidate'
+    return response
 
 
 @app.route('/api/contacts', methods=['GET'])
 def get_contacts():
-    contacts = Contact.query.all()
-    return jsonify([{
-        'id': c.id,
-        'firstName': c.first_name,
-        'lastName': c.last_name,
-        'emails': [{'id': e.id, 'email': e.email} for e in c.emails],
-        'createdAt': c.created_at.isoformat(),
-        'updatedAt': c.updated_at.isoformat()
-    } for c in contacts])
+    last_updated, count = db.session.query(
+        func.max(Contact.updated_at), func.count(Contact.id)).one()
+    etag = hashlib.md5(f"{last_updated}-{count}".encode(), usedforsecurity=False).hexdigest()
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    # read-only path: fetch plain rows in one joined query instead of hydrating ORM objects
+    rows = db.session.execute(
+        select(Contact.id, Contact.first_name, Contact.last_name, Contact.created_at,
+               Contact.updated_at, Email.id, Email.email)
+        .outerjoin(Email, Email.contact_id == Contact.id)
+        .order_by(Contact.id, Email.id)).yield_per(200)
+
+    def generate():
+        # rows arrive grouped by contact, so each contact is emitted as soon as the next one starts
+        yield b'['
+        separator = b''
+        contact = None
+        for contact_id, first_name, last_name, created_at, updated_at, email_id, email in rows:
+            if contact is None or contact['id'] != contact_id:
+                if contact is not None:
+                    yield separator + orjson.dumps(contact, option=OrjsonProvider.option)
+                    separator = b','
+                contact = {
+                    'id': contact_id,
+                    'firstName': first_name,
+                    'lastName': last_name,
+                    'emails': [],
+                    'createdAt': created_at,
+                    'updatedAt': updated_at
+                }
+            if email_id is not None:
+                contact['emails'].append({'id': email_id, 'email': email})
+        if contact is not None:
+            yield separator + orjson.dumps(contact, option=OrjsonProvider.option)
+        yield b']'
+
+    return set_cache_headers(
+        Response(stream_with_context(generate()), mimetype='application/json'), etag)
 
 
 @app.route('/api/contacts/<int:contact_id>', methods=['GET'])
 def get_contact(contact_id):
-    contact = db.session.get(Contact, contact_id)
+    contact = load_contact(contact_id)
     if contact is None:
         return jsonify({'error': 'Contact not found'}), 404
-    return jsonify({
-        'id': contact.id,
-        'firstName': contact.first_name,
-        'lastName': contact.last_name,
-        'emails': [{'id': e.id, 'email': e.email} for e in contact.emails],
-        'createdAt': contact.created_at.isoformat(),
-        'updatedAt': contact.updated_at.isoformat()
-    })
+    etag = hashlib.md5(contact.updated_at.isoformat().encode(), usedforsecurity=False).hexdigest()
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    return set_cache_headers(jsonify(contact.to_dict()), etag)
+
+
+def clean_emails(emails_in):
+    """Validate submitted emails with clean_email, dropping repeats; raises ValueError."""
+    return list(dict.fromkeys(clean_email(email_data['email']) for email_data in emails_in))
+
+
+def insert_emails(contact_id, addresses):
+    """Insert all addresses for a contact as one multi-row INSERT, bypassing ORM unit of work."""
+    if addresses:
+        db.session.execute(Email.__table__.insert().values(
+            [{'email': address, 'contact_id': contact_id} for address in addresses]))
 
 
 @app.route('/api/contacts', methods=['POST'])
@@ -142,68 +271,62 @@ def create_contact():
             last_name=sanitize_input(data['lastName'])
         )
 
-        for email_data in data.get('emails', []):
-            if len(email_data['email']) > EMAIL_FIELD_SIZE:
-                raise ValueError(f"Email is too long: {email_data['email']}")
-            if not is_valid_email(email_data['email']):
-                raise ValueError(f"Invalid email format: {email_data['email']}")
-            contact.emails.append(Email(email=sanitize_input(email_data['email'])))
+        addresses = clean_emails(data.get('emails', []))
 
         db.session.add(contact)
+        db.session.flush()
+        insert_emails(contact.id, addresses)
         db.session.commit()
 
-        return jsonify({
-            'id': contact.id,
-            'firstName': contact.first_name,
-            'lastName': contact.last_name,
-            'emails': [{'id': e.id, 'email': e.email} for e in contact.emails],
-            'createdAt': contact.created_at.isoformat(),
-            'updatedAt': contact.updated_at.isoformat()
-        }), 201
+        return jsonify(contact.to_dict()), 201
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
 
 @app.route('/api/contacts/<int:contact_id>', methods=['PUT'])
 def update_contact(contact_id):
-    contact = db.session.get(Contact, contact_id)
+    contact = load_contact(contact_id)
     if contact is None:
         return jsonify({'error': 'Contact not found'}), 404
     data = request.get_json()
 
-    if not data.get('firstName') or not data.get('lastName'):
-        return jsonify({'error': 'First name and last name are required'}), 400
+    try:
+        if not data.get('firstName') or not data.get('lastName'):
+            raise ValueError("First name and last name are required")
 
-    contact.first_name = sanitize_input(data['firstName'])
-    contact.last_name = sanitize_input(data['lastName'])
+        if len(data['firstName']) > NAME_FIELD_SIZE or len(data['lastName']) > NAME_FIELD_SIZE:
+            raise ValueError("First name or last name is too long")
 
-    # Remove existing emails
-    Email.query.filter_by(contact_id=contact.id).delete()
+        first_name = sanitize_input(data['firstName'])
+        last_name = sanitize_input(data['lastName'])
+        new_emails = clean_emails(data.get('emails', []))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    # Add new emails
-    for email_data in data.get('emails', []):
-        if len(email_data['email']) > 120:
-            return jsonify({'error': f"Email is too long: {email_data['email']}"}), 400
-        if not is_valid_email(email_data['email']):
-            return jsonify({'error': f"Invalid email format: {email_data['email']}"}), 400
-        email = Email(email=sanitize_input(email_data['email']))
-        contact.emails.append(email)
+    contact.first_name = first_name
+    contact.last_name = last_name
+    # bump explicitly: an email-only change wouldn't otherwise touch the contact row (or its ETag)
+    contact.updated_at = timenow()
+
+    # Only touch the rows that changed; an unchanged email list issues no email DML
+    # (older rows may repeat an address; only the first copy of a wanted address is kept)
+    wanted = set(new_emails)
+    kept = set()
+    for email in list(contact.emails):
+        if email.email in wanted and email.email not in kept:
+            kept.add(email.email)
+        else:
+            contact.emails.remove(email)
+    insert_emails(contact.id, [a for a in new_emails if a not in kept])
 
     db.session.commit()
 
-    return jsonify({
-        'id': contact.id,
-        'firstName': contact.first_name,
-        'lastName': contact.last_name,
-        'emails': [{'id': e.id, 'email': e.email} for e in contact.emails],
-        'createdAt': contact.created_at.isoformat(),
-        'updatedAt': contact.updated_at.isoformat()
-    })
+    return jsonify(contact.to_dict())
 
 
 @app.route('/api/contacts/<int:contact_id>', methods=['DELETE'])
 def delete_contact(contact_id):
-    contact = db.session.get(Contact, contact_id)
+    contact = load_contact(contact_id)
     if contact is None:
         return jsonify({'error': 'Contact not found'}), 404
     db.session.delete(contact)
@@ -211,14 +334,26 @@ def delete_contact(contact_id):
     return '', 204
 
 
+@app.errorhandler(413)
+def request_too_large(error):  # pylint: disable=W0613
+    return jsonify({'error': 'Request too large'}), 413
+
+
+# Flask-CORS only sends Allow-Headers/Allow-Methods on preflight, so plain responses get them here
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Methods': 'GET,PUT,POST,DELETE',
+}
+
+
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
+    response.headers.update(CORS_HEADERS)
     return response
 
 
 port = int(os.environ.get('PORT', 5001))
 if __name__ == '__main__':
+    init_db()
     app.run(host='0.0.0.0', port=port)
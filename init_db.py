@@ -1,8 +1,4 @@
-from app import app, db
-
-def init_db():
-    with app.app_context():
-        db.create_all()
+from app import init_db
 
 if __name__ == '__main__':
     init_db()
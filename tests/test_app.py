@@ -14,11 +14,15 @@ Test Cases:
     - Input validation for required fields, email formats, and field length limits.
     - Security against SQL injection and XSS.
     - CORS header verification.
+    - Query counts for list endpoints (N+1 regressions).
 """
 
 
+from contextlib import contextmanager
 import pytest
-from ..app import app, db, Contact, Email  # pylint: disable=W0611
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+from ..app import app, db, load_contact, Contact, Email  # pylint: disable=W0611
 
 # pylint: disable=W0621
 
@@ -28,6 +32,7 @@ def client():
     """Set up and provide a test client with an isolated test database."""
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
     app.config['TESTING'] = True
+    app.config['TESTING_STRICT_LOADS'] = True
     with app.test_client() as client:
         with app.app_context():
             db.create_all()
@@ -36,6 +41,23 @@ def client():
             db.drop_all()
 
 
+@contextmanager
+def count_queries():
+    """Collect the SELECT statements issued against the engine while active."""
+    queries = []
+
+    # pylint: disable-next=W0613
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
 def test_create_contact(client):
     """Test the creation of a new contact with valid data."""
     response = client.post('/api/contacts', json={
@@ -113,6 +135,17 @@ def test_sql_injection(client):
     assert "error" in response.json or response.json['firstName'] != "'; DROP TABLE contacts; --"
 
 
+def test_sql_injection_unicode_case_folding(client):
+    """Test that SQL keywords using non-ASCII case variants are still rejected."""
+    for name in ['İnsert', 'ınsert']:
+        response = client.post('/api/contacts', json={
+            'firstName': name,
+            'lastName': 'User'
+        })
+        assert response.status_code == 400
+        assert response.json['error'] == 'Invalid input detected'
+
+
 def test_xss_injection(client):
     """Test if XSS injection attempts are properly handled."""
     response = client.post('/api/contacts', json={
@@ -136,6 +169,17 @@ def test_long_input(client):
     assert "error" in response.json or len(response.json['firstName']) < 255
 
 
+def test_oversized_request(client):
+    """Test that request bodies over MAX_CONTENT_LENGTH are rejected before parsing."""
+    response = client.post('/api/contacts', json={
+        'firstName': "A" * (100 * 1024),
+        'lastName': 'User',
+        'emails': [{'email': 'test@example.com'}]
+    })
+    assert response.status_code == 413
+    assert response.json['error'] == 'Request too large'
+
+
 def test_invalid_email(client):
     """Test validation for invalid email addresses."""
     response = client.post('/api/contacts', json={
@@ -190,6 +234,19 @@ def test_create_contact_invalid_email(client):
     assert response.json['error'] == 'Invalid email format: invalidemail'
 
 
+def test_create_contact_email_with_markup(client):
+    """Test that emails containing markup or SQL metacharacters are rejected."""
+    for bad_email in ['<script>@example.com', 'a;b@example.com', 'a--b@example.com',
+                      'x@y.com\n']:
+        response = client.post('/api/contacts', json={
+            'firstName': 'John',
+            'lastName': 'Smith',
+            'emails': [{'email': bad_email}]
+        })
+        assert response.status_code == 400
+        assert response.json['error'] == f'Invalid email format: {bad_email}'
+
+
 def test_create_contact_email_too_long(client):
     """Test error handling for emails exceeding the maximum allowed length."""
     long_email = 'a' * 121 + '@example.com'
@@ -202,6 +259,75 @@ def test_create_contact_email_too_long(client):
     assert response.json['error'] == f"Email is too long: {long_email}"
 
 
+def test_update_contact_email_too_long(client):
+    """Test that updates reject emails exceeding the maximum allowed length."""
+    create_response = client.post('/api/contacts', json={
+        'firstName': 'John',
+        'lastName': 'Smith',
+        'emails': [{'email': 'john@example.com'}]
+    })
+    contact_id = create_response.json['id']
+    long_email = 'a' * 121 + '@example.com'
+    response = client.put(f'/api/contacts/{contact_id}', json={
+        'firstName': 'John',
+        'lastName': 'Smith',
+        'emails': [{'email': long_email}]
+    })
+    assert response.status_code == 400
+    assert response.json['error'] == f"Email is too long: {long_email}"
+
+
+def test_duplicate_emails(client):
+    """Test that repeated addresses are stored once and stale duplicates are removable."""
+    response = client.post('/api/contacts', json={
+        'firstName': 'Test',
+        'lastName': 'User',
+        'emails': [{'email': 'a@example.com'}, {'email': 'a@example.com'}]
+    })
+    assert [e['email'] for e in response.json['emails']] == ['a@example.com']
+
+    # rows saved before deduplication may still repeat an address
+    contact = Contact(first_name='Old', last_name='User',
+                      emails=[Email(email='a@example.com') for _ in range(3)])
+    db.session.add(contact)
+    db.session.commit()
+    contact_id = contact.id
+
+    response = client.put(f'/api/contacts/{contact_id}', json={
+        'firstName': 'Old',
+        'lastName': 'User',
+        'emails': [{'email': 'a@example.com'}]
+    })
+    assert response.status_code == 200
+    assert [e['email'] for e in response.json['emails']] == ['a@example.com']
+
+    response = client.put(f'/api/contacts/{contact_id}', json={
+        'firstName': 'Old',
+        'lastName': 'User',
+        'emails': []
+    })
+    assert response.status_code == 200
+    assert client.get(f'/api/contacts/{contact_id}').json['emails'] == []
+
+
+def test_update_contact_invalid_input(client):
+    """Test that invalid update input returns 400 and leaves the contact unchanged."""
+    create_response = client.post('/api/contacts', json={
+        'firstName': 'John',
+        'lastName': 'Smith',
+        'emails': [{'email': 'john@example.com'}]
+    })
+    contact_id = create_response.json['id']
+    response = client.put(f'/api/contacts/{contact_id}', json={
+        'firstName': "'; DROP TABLE contacts; --",
+        'lastName': 'Smith',
+        'emails': [{'email': 'john@example.com'}]
+    })
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid input detected'
+    assert client.get(f'/api/contacts/{contact_id}').json['firstName'] == 'John'
+
+
 def test_delete_nonexistent_contact(client):
     """Test deletion attempt of a non-existent contact."""
     response = client.delete('/api/contacts/9999')  # assuming ID 9999 doesn't exist
@@ -239,3 +365,102 @@ def test_cors_headers(client):
     assert response.headers['Access-Control-Allow-Origin'] == '*'
     assert response.headers['Access-Control-Allow-Methods'] == 'GET,PUT,POST,DELETE'
     assert response.headers['Access-Control-Allow-Headers'] == 'Content-Type'
+
+
+def test_no_n_plus_one(client):
+    """Test that listing contacts costs a fixed number of queries, not one per contact."""
+    db.session.add_all([
+        Contact(first_name=f'Test{i}', last_name='User',
+                emails=[Email(email=f'user{i}.{j}@example.com') for j in range(3)])
+        for i in range(50)
+    ])
+    db.session.commit()
+    with count_queries() as queries:
+        response = client.get('/api/contacts')
+        contacts = response.json
+    assert response.status_code == 200
+    assert len(contacts) == 50
+    assert all(len(c['emails']) == 3 for c in contacts)
+    # ETag aggregate, then a single joined contacts/emails query
+    assert len(queries) <= 2
+
+
+def test_strict_loads(client):
+    """Test that strict mode makes unplanned lazy loads on contact lookups raise."""
+    response = client.post('/api/contacts', json={
+        'firstName': 'Test',
+        'lastName': 'User',
+        'emails': [{'email': 'test@example.com'}]
+    })
+    # drop the seeded instance so the lookup loads fresh, as it would in its own request
+    db.session.expire_all()
+    contact = load_contact(response.json['id'])
+    assert contact.emails[0].email == 'test@example.com'
+    with pytest.raises(InvalidRequestError):
+        _ = contact.emails[0].contact
+
+
+def test_get_contacts_etag(client):
+    """Test that the contact list returns 304 until the data changes."""
+    client.post('/api/contacts', json={
+        'firstName': 'Test',
+        'lastName': 'User',
+        'emails': [{'email': 'test@example.com'}]
+    })
+    response = client.get('/api/contacts')
+    assert len(response.json) == 1
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'private, must-revalidate'
+
+    response = client.get('/api/contacts', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    client.post('/api/contacts', json={'firstName': 'Second', 'lastName': 'User'})
+    response = client.get('/api/contacts', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.json) == 2
+
+
+def test_get_contact_etag(client):
+    """Test that a single contact returns 304 until it is updated."""
+    create_response = client.post('/api/contacts', json={
+        'firstName': 'Test',
+        'lastName': 'User',
+        'emails': [{'email': 'test@example.com'}]
+    })
+    contact_id = create_response.json['id']
+    etag = client.get(f'/api/contacts/{contact_id}').headers['ETag']
+
+    response = client.get(f'/api/contacts/{contact_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    client.put(f'/api/contacts/{contact_id}', json={
+        'firstName': 'Test',
+        'lastName': 'User',
+        'emails': [{'email': 'changed@example.com'}]
+    })
+    response = client.get(f'/api/contacts/{contact_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json['emails'][0]['email'] == 'changed@example.com'
+
+
+def test_update_contact_keeps_unchanged_emails(client):
+    """Test that updating a contact only replaces the emails that changed."""
+    create_response = client.post('/api/contacts', json={
+        'firstName': 'Test',
+        'lastName': 'User',
+        'emails': [{'email': 'keep@example.com'}, {'email': 'old@example.com'}]
+    })
+    contact_id = create_response.json['id']
+    kept_id = next(e['id'] for e in create_response.json['emails']
+                   if e['email'] == 'keep@example.com')
+    response = client.put(f'/api/contacts/{contact_id}', json={
+        'firstName': 'Test',
+        'lastName': 'User',
+        'emails': [{'email': 'keep@example.com'}, {'email': 'new@example.com'}]
+    })
+    assert response.status_code == 200
+    emails = {e['email']: e['id'] for e in response.json['emails']}
+    assert set(emails) == {'keep@example.com', 'new@example.com'}
+    assert emails['keep@example.com'] == kept_id